@@ -10,35 +10,129 @@
 optimize_resources.py
 
 Compute:
-  - Optimal threads-per-job (capped at 16, min 1).
+  - Optimal threads-per-job (min 1, optionally capped with --max-threads).
   - Max concurrent jobs under a 90% RAM usage cap.
   - Number of full batches needed to run TOTAL_JOBS.
 
 Usage:
-    ./optimize_resources.py TOTAL_JOBS MEM_PER_JOB_GB
+    ./optimize_resources.py TOTAL_JOBS MEM_PER_JOB_GB [--max-threads N]
 """
 
 import argparse
-import multiprocessing
+import functools
 import os
+import re
 import sys
 import math
 
-def get_total_ram_gb():
+def _cgroup_dirs(controller):
+    """This process's cgroup directories for a controller, leaf to root.
+
+    Limits set on an ancestor (SLURM job, systemd slice) apply to the whole
+    subtree, so callers should combine every level.  The mount root comes
+    last; containers usually see their own cgroup mounted there.
+    """
+    try:
+        with open('/proc/self/cgroup') as f:
+            entries = [line.rstrip('\n').split(':', 2) for line in f]
+    except OSError:
+        return []
+    dirs = []
+    for _, controllers, path in entries:
+        if controllers == '':
+            base = '/sys/fs/cgroup'
+        elif controller in controllers.split(','):
+            base = f'/sys/fs/cgroup/{controllers}'
+        else:
+            continue
+        path = path.rstrip('/')
+        while path:
+            dirs.append(f'{base}{path}')
+            path = path.rpartition('/')[0]
+        dirs.append(base)
+    return dirs
+
+def _cgroup_read(cgroup_dir, name):
+    """Read one cgroup control file, or None if it doesn't exist."""
+    try:
+        with open(f'{cgroup_dir}/{name}') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def _performance_cpus(cpus):
+    """Drop the efficiency class on hybrid (P/E-core) parts.
+
+    Favoured P-cores and Arm prime cores report a slightly higher capacity
+    than the rest of their class, so keep everything within 80% of the
+    fastest CPU rather than only the exact maximum.
+    """
+    capacity = {}
+    for cpu in cpus:
+        try:
+            with open(f'/sys/devices/system/cpu/cpu{cpu}/cpu_capacity') as f:
+                capacity[cpu] = int(f.read())
+        except (OSError, ValueError):
+            return list(cpus)       # not exposed: treat as homogeneous
+    top = max(capacity.values(), default=0)
+    return [cpu for cpu in cpus if capacity[cpu] * 5 >= top * 4]
+
+@functools.lru_cache(maxsize=None)
+def get_total_cores():
+    # Respect taskset/SLURM affinity masks, skip efficiency cores, then
+    # apply any cgroup CPU quota
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = range(os.cpu_count() or 1)
+    cores = max(1, len(_performance_cpus(cpus)))
+
+    # The tightest quota anywhere between our cgroup and the root wins
+    for cgroup_dir in _cgroup_dirs('cpu'):
+        cpu_max = _cgroup_read(cgroup_dir, 'cpu.max')   # v2: "<quota> <period>"
+        if cpu_max:
+            quota, _, period = cpu_max.partition(' ')
+        else:                                            # v1
+            quota = _cgroup_read(cgroup_dir, 'cpu.cfs_quota_us')
+            period = _cgroup_read(cgroup_dir, 'cpu.cfs_period_us')
+        try:
+            quota, period = int(quota), int(period)
+        except (TypeError, ValueError):                  # unlimited ("max") or absent
+            continue
+        if quota > 0 and period > 0:
+            cores = min(cores, max(1, math.ceil(quota / period)))
+    return cores
+
+@functools.lru_cache(maxsize=None)
+def get_total_ram_mb():
     try:
         page_size = os.sysconf('SC_PAGE_SIZE')
         phys_pages = os.sysconf('SC_PHYS_PAGES')
         total_bytes = page_size * phys_pages
-        return total_bytes / (1024**3)
     except (AttributeError, ValueError):
         with open('/proc/meminfo') as f:
-            for line in f:
-                if line.startswith('MemTotal:'):
-                    kb = int(line.split()[1])
-                    return kb / 1024**2
-        sys.exit("Unable to determine total system RAM.")
-
-def parse_args():
+            m = re.search(r'^MemTotal:\s*(\d+)', f.read(), re.MULTILINE)
+        if not m:
+            sys.exit("Unable to determine total system RAM.")
+        total_bytes = int(m.group(1)) * 1024
+
+    # A cgroup memory limit (container, SLURM --mem) caps what we can use;
+    # it is often set on an ancestor, so take the tightest along the path
+    for cgroup_dir in _cgroup_dirs('memory'):
+        limit = _cgroup_read(cgroup_dir, 'memory.max')                 # v2
+        if limit is None:
+            limit = _cgroup_read(cgroup_dir, 'memory.limit_in_bytes')  # v1
+        if limit and limit.isdigit():
+            total_bytes = min(total_bytes, int(limit))
+    return total_bytes // 1024**2
+
+def get_usable_ram_mb():
+    # 90% of RAM as the integer ratio 9/10, so rounding near the boundary
+    # can never admit one job too many
+    return get_total_ram_mb() * 9 // 10
+
+@functools.lru_cache(maxsize=None)
+def _build_parser():
     p = argparse.ArgumentParser(
         description="Compute optimal CPU and RAM allocation for batch jobs."
     )
@@ -52,7 +146,16 @@ def parse_args():
         type=float,
         help="Peak RAM required per job, in GB"
     )
-    return p.parse_args()
+    p.add_argument(
+        "--max-threads",
+        type=int,
+        default=None,
+        help="Upper bound on threads per job (default: no cap, use all cores)"
+    )
+    return p
+
+def parse_args(argv=None):
+    return _build_parser().parse_args(argv)
 
 def main():
     args = parse_args()
@@ -62,33 +165,52 @@ def main():
     if J < 1:
         print("Error: TOTAL_JOBS must be >= 1", file=sys.stderr)
         sys.exit(1)
-    if M <= 0:
-        print("Error: MEM_PER_JOB_GB must be > 0", file=sys.stderr)
+    if not math.isfinite(M) or M <= 0:
+        print("Error: MEM_PER_JOB_GB must be a finite number > 0", file=sys.stderr)
+        sys.exit(1)
+    if args.max_threads is not None and args.max_threads < 1:
+        print("Error: --max-threads must be >= 1", file=sys.stderr)
         sys.exit(1)
 
-    # Detect total logical CPU cores
-    total_cores = multiprocessing.cpu_count()
-
-    # Detect total system RAM in GB
-    total_ram_gb = get_total_ram_gb()
+    # Detect CPU cores available to this process
+    total_cores = get_total_cores()
+
+    # Detect total system RAM in MB. The fits-in-RAM check runs on the
+    # float before rounding (ceil(x) > n iff x > n for integer n), so huge
+    # values can't overflow; everything after stays integer and only
+    # converts back to GB for messages
+    total_ram_mb = get_total_ram_mb()
+    if M * 1024 > total_ram_mb:
+        print(f"Error: MEM_PER_JOB_GB ({M:g}) exceeds RAM available to this "
+              f"process ({total_ram_mb / 1024:.2f} GB)", file=sys.stderr)
+        sys.exit(1)
+    mem_per_job_mb = math.ceil(M * 1024)
 
     # Compute max jobs by RAM at 90% usage
-    usable_ram_gb = total_ram_gb * 0.9
-    max_mem_jobs = max(1, int(usable_ram_gb // M))
+    max_mem_jobs = max(1, get_usable_ram_mb() // mem_per_job_mb)
 
     # Actual parallel jobs is min(TOTAL_JOBS, RAM-limited)
     parallel_jobs = min(J, max_mem_jobs)
 
-    # Compute threads-per-job: integer divide, cap [1..16]
-    tpj = total_cores // parallel_jobs
-    tpj = min(max(tpj, 1), 16)
-
     # Compute how many full batches are needed
     batches = math.ceil(J / parallel_jobs)
 
-    print(f"Threads per job:  {tpj}")
-    print(f"Parallel jobs:    {parallel_jobs}")
-    print(f"Batches needed:   {batches}")
+    # Spread jobs evenly over those batches: the batch count is unchanged,
+    # but the last batch isn't left half empty and every job gets the
+    # threads freed up by running fewer at once
+    parallel_jobs = math.ceil(J / batches)
+
+    # Compute threads-per-job: integer divide, at least 1, at most
+    # --max-threads when given
+    tpj = max(total_cores // parallel_jobs, 1)
+    if args.max_threads is not None:
+        tpj = min(tpj, args.max_threads)
+
+    sys.stdout.write(
+        f"Threads per job:  {tpj}\n"
+        f"Parallel jobs:    {parallel_jobs}\n"
+        f"Batches needed:   {batches}\n"
+    )
 
 if __name__ == "__main__":
     main()
@@ -37,9 +37,15 @@ esac
 # Ask optimize_workflow.py for TPJ, PARALLEL & BATCHES
 read -r TPJ PARALLEL BATCHES <<<"$(
   "${WORKFLOW_DIR}/optimize_workflow.py" "$TOTAL_SUBJECTS" "$RAM" \
+    ${MAX_THREADS_PER_JOB:+--max-threads "$MAX_THREADS_PER_JOB"} \
     | awk '/Threads per job|Parallel jobs|Batches needed/ {print $NF}' \
     | tr '\n' ' '
 )"
+# read <<<"$(...)" hides the optimizer's exit status, so check its output
+if [[ -z "${TPJ:-}" || -z "${PARALLEL:-}" ]]; then
+  echo "optimize_workflow.py gave no allocation for ${PHASE}; aborting" >&2
+  exit 1
+fi
 echo "[${PHASE}] threads/job=${TPJ}  parallel_jobs=${PARALLEL}  batches=${BATCHES}"
 
 export OMP_NUM_THREADS="$TPJ"   # per‑job thread fan‑out